@@ -1,5 +1,6 @@
 from libra_toolbox.tritium.model import ureg, Model, quantity_to_activity
 import numpy as np
+import pandas as pd
 import json
 from libra_toolbox.tritium.lsc_measurements import (
     LIBRARun,
@@ -10,63 +11,116 @@ from libra_toolbox.tritium.lsc_measurements import (
 )
 
 import warnings
-from scipy.interpolate import interp1d
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
 
 
-all_file_readers = []
+BACKGROUND_LABELS = ["1L-BL-1", "1L-BL-2", "1L-BL-3", "1L-BL-4"]
+
+_reader_cache: dict[str, LSCFileReader] = {}
+_background_cache: dict[str, LSCSample] = {}
+_row_index_cache: dict[int, dict[str, dict]] = {}
 all_quench = []
 
 
-def create_sample(label: str, filename: str, background_curve=None) -> LSCSample:
+DATETIME_FORMAT = "%m/%d/%Y %H:%M"
+
+
+def _parse_dts(strings: list[str]) -> list[datetime]:
+    # parse all strings in a single vectorized pandas call
+    return list(pd.to_datetime(strings, format=DATETIME_FORMAT).to_pydatetime())
+
+
+def _to_json_serializable(obj):
+    # json.dump hook for the numpy arrays and scalars in processed_data
+    if isinstance(obj, (np.ndarray, np.generic)):
+        return obj.tolist()
+    raise TypeError(f"Object of type {type(obj).__name__} is not JSON serializable")
+
+
+def get_file_reader(filename: str) -> LSCFileReader:
     """
-    Create a LSCSample from a LSC file with background substracted.
+    Get the LSCFileReader for a LSC file, reading the file only once.
 
     Args:
-        label: the label of the sample in the LSC file
         filename: the filename of the LSC file
 
     Returns:
-        the LSCSample object
+        the LSCFileReader object with its data loaded
     """
-    # check if a LSCFileReader has been created for this filename
-    found = False
-    for file_reader in all_file_readers:
-        if file_reader.filename == filename:
-            found = True
-            break
+    if filename not in _reader_cache:
+        _reader_cache[filename] = _read_lsc_file(filename)
+    return _reader_cache[filename]
+
 
-    # if not, create it and add it to the list of LSCFileReaders
-    if not found:
-        file_reader = LSCFileReader(filename, labels_column="SMPL_ID")
+def preload_file_readers(filenames: list[str]) -> None:
+    """
+    Read several LSC files in parallel and cache their LSCFileReaders.
 
+    Args:
+        filenames: the filenames of the LSC files
+    """
+    missing = [filename for filename in filenames if filename not in _reader_cache]
+    # pandas releases the GIL while parsing the CSV files
+    with ThreadPoolExecutor() as executor:
+        _reader_cache.update(zip(missing, executor.map(_read_lsc_file, missing)))
+
+
+def _read_lsc_file(filename: str) -> LSCFileReader:
+    file_reader = LSCFileReader(filename, labels_column="SMPL_ID")
     file_reader.read_file()
+    return file_reader
 
-    # create the sample
-    sample = LSCSample.from_file(file_reader, label)
 
-    if background_curve:
-        sample_data = get_row_by_label(file_reader, label)
-        tSIE = float(sample_data["tSIE"])
-        background_bq = background_curve(tSIE)
-        substract_scalar_background(sample, background_bq)
-    else:
-        # try to find the background sample from the file
-        background_labels = ["1L-BL-1", "1L-BL-2", "1L-BL-3", "1L-BL-4"]
-        background_sample = None
+def get_background_sample(filename: str) -> LSCSample:
+    """
+    Get the background sample of a LSC file, looking it up only once.
 
-        for background_label in background_labels:
-            try:
-                background_sample = LSCSample.from_file(file_reader, background_label)
-                break
-            except ValueError:
-                continue
+    Args:
+        filename: the filename of the LSC file
 
-        if background_sample is None:
+    Returns:
+        the first sample of the file labelled with one of BACKGROUND_LABELS
+    """
+    if filename not in _background_cache:
+        file_reader = get_file_reader(filename)
+        row_index = _get_row_index(file_reader)
+        for background_label in BACKGROUND_LABELS:
+            if background_label in row_index:
+                break
+        else:
             raise ValueError(f"Background sample not found in {filename}")
+        _background_cache[filename] = LSCSample.from_file(
+            file_reader, background_label
+        )
+    return _background_cache[filename]
+
+
+def create_sample(
+    label: str, filename: str, background_bq: float | None = None
+) -> LSCSample:
+    """
+    Create a LSCSample from a LSC file with background substracted.
+
+    Args:
+        label: the label of the sample in the LSC file
+        filename: the filename of the LSC file
+        background_bq: the background activity (in Bq) to substract. If None,
+            the background sample is read from the LSC file
+
+    Returns:
+        the LSCSample object
+    """
+    file_reader = get_file_reader(filename)
 
-        # substract background
-        sample.substract_background(background_sample)
+    # create the sample
+    sample = LSCSample.from_file(file_reader, label)
+
+    if background_bq is not None:
+        substract_scalar_background(sample, background_bq)
+    else:
+        # substract the background sample from the file
+        sample.substract_background(get_background_sample(filename))
 
     # read quench set
     all_quench.append(file_reader.quench_set)
@@ -74,26 +128,64 @@ def create_sample(label: str, filename: str, background_curve=None) -> LSCSample
     return sample
 
 
-def get_row_by_label(reader: LSCFileReader, label: str) -> dict:
+def compute_scalar_backgrounds(
+    filename: str, labels: list[str], background_curve
+) -> dict[str, float]:
+    """
+    Evaluate the background curve for several samples of a LSC file at once.
+
+    Args:
+        filename: the filename of the LSC file
+        labels: the labels of the samples in the LSC file
+        background_curve: callable returning the background activity (in Bq)
+            for an array of tSIE values
+
+    Returns:
+        a dict mapping each label to its background activity (in Bq)
+    """
+    reader = get_file_reader(filename)
+    tSIE_arr = np.array([get_tSIE(reader, label) for label in labels])
+    background_arr = background_curve(tSIE_arr)
+    return dict(zip(labels, background_arr.tolist()))
+
+
+def _get_row_index(reader: LSCFileReader) -> dict[str, dict]:
     if reader.data is None:
         raise ValueError("Data not loaded. Call reader.read_file() first.")
     if reader.labels_column is None:
         raise ValueError("labels_column is not set in reader.")
-    row = reader.data[reader.data[reader.labels_column] == label]
-    if row.empty:
-        raise ValueError(f"Label '{label}' not found in data.")
-    return row.iloc[0].to_dict()
+    # build the label -> row mapping once per reader, on first query
+    # (readers are kept alive by _reader_cache, so their id is stable)
+    if id(reader) not in _row_index_cache:
+        unique_rows = reader.data.drop_duplicates(subset=reader.labels_column)
+        _row_index_cache[id(reader)] = {
+            row[reader.labels_column]: row
+            for row in unique_rows.to_dict(orient="records")
+        }
+    return _row_index_cache[id(reader)]
+
+
+def get_row_by_label(reader: LSCFileReader, label: str) -> dict:
+    row_index = _get_row_index(reader)
+    try:
+        return row_index[label]
+    except KeyError:
+        raise ValueError(f"Label '{label}' not found in data.") from None
+
+
+def get_tSIE(reader: LSCFileReader, label: str) -> float:
+    return float(get_row_by_label(reader, label)["tSIE"])
 
 
 def substract_scalar_background(sample: LSCSample, background_bq: float) -> None:
     if sample.background_substracted:
-            raise ValueError("Background already substracted")
-    sample.activity -= background_bq * ureg.Bq
-    if sample.activity.magnitude < 0:
+        raise ValueError("Background already substracted")
+    activity_bq = sample.activity.to(ureg.Bq).magnitude - background_bq
+    if activity_bq < 0:
         warnings.warn(
             f"Activity of {sample.name} is negative after substracting background. Setting to zero."
         )
-        sample.activity = 0 * ureg.Bq
+    sample.activity = max(activity_bq, 0.0) * ureg.Bq
     sample.background_substracted = True
 
 
@@ -102,15 +194,43 @@ def build_background_curve_from_file(reader: LSCFileReader, blank_labels: list[s
     Bq_values = []
 
     for label in blank_labels:
-        sample_data = get_row_by_label(reader, label)
-        tSIE = float(sample_data["tSIE"])
+        tSIE = get_tSIE(reader, label)
         sample = LSCSample.from_file(reader, label)
         Bq = sample.activity.magnitude
         tSIE_values.append(tSIE)
         Bq_values.append(Bq)
 
-    interpolator = interp1d(tSIE_values, Bq_values, bounds_error=False, fill_value="extrapolate")
-    return interpolator
+    # sort once so np.interp can be used directly
+    tSIE_arr = np.asarray(tSIE_values, dtype=float)
+    Bq_arr = np.asarray(Bq_values, dtype=float)
+    idx = np.argsort(tSIE_arr)
+    tSIE_arr = tSIE_arr[idx]
+    Bq_arr = Bq_arr[idx]
+
+    if len(tSIE_arr) < 2:
+        raise ValueError(
+            f"At least two blanks are needed for the background curve, "
+            f"got {blank_labels}"
+        )
+    if not np.all(np.diff(tSIE_arr) > 0):
+        raise ValueError(f"Blanks {blank_labels} must have distinct tSIE values")
+
+    # slopes of the end segments for linear extrapolation
+    slope_low = (Bq_arr[1] - Bq_arr[0]) / (tSIE_arr[1] - tSIE_arr[0])
+    slope_high = (Bq_arr[-1] - Bq_arr[-2]) / (tSIE_arr[-1] - tSIE_arr[-2])
+
+    def background_curve(tSIE):
+        tSIE = np.asarray(tSIE, dtype=float)
+        Bq = np.interp(tSIE, tSIE_arr, Bq_arr)
+        Bq = np.where(
+            tSIE < tSIE_arr[0], Bq_arr[0] + slope_low * (tSIE - tSIE_arr[0]), Bq
+        )
+        Bq = np.where(
+            tSIE > tSIE_arr[-1], Bq_arr[-1] + slope_high * (tSIE - tSIE_arr[-1]), Bq
+        )
+        return Bq
+
+    return background_curve
 
 
 lsc_data_folder = "../../data/tritium_detection"
@@ -123,8 +243,7 @@ if "tritium_blank_set" in general_data:
     curved_bkgr = True
     blank_info = general_data["tritium_blank_set"]
     background_file = f"{lsc_data_folder}/{blank_info['filename']}"
-    background_reader = LSCFileReader(background_file, labels_column="SMPL_ID")
-    background_reader.read_file()
+    background_reader = get_file_reader(background_file)
 
     blank_labels = list(blank_info["blanks"].keys())
     background_curve = build_background_curve_from_file(background_reader, blank_labels)
@@ -132,45 +251,87 @@ else:
     curved_bkgr = False
     background_curve = None
 
-# read start time from general.json
-all_start_times = []
-for generator in general_data["generators"]:
-    if generator["enabled"] is False:
-        continue
-    for irradiation_period in generator["periods"]:
-        start_time = datetime.strptime(irradiation_period["start"], "%m/%d/%Y %H:%M")
-        all_start_times.append(start_time)
-start_time = min(all_start_times)
+# read irradiation periods and start time from general.json
+enabled_periods = [
+    irradiation_period
+    for generator in general_data["generators"]
+    if generator["enabled"]
+    for irradiation_period in generator["periods"]
+]
+irradiation_periods = list(
+    zip(
+        _parse_dts([period["start"] for period in enabled_periods]),
+        _parse_dts([period["end"] for period in enabled_periods]),
+    )
+)
+start_time = min(start for start, _ in irradiation_periods)
 
 
-# create gas streams
-gas_streams = {}
+# collect the sample times and the (stream, sample_nb, label, filename) of each vial
+sample_time_strings = {}
+vials = []
 for stream, samples in general_data["tritium_detection"].items():
-    stream_samples = []
     for sample_nb, sample_dict in samples.items():
-        libra_samples = []
         if sample_dict["actual_sample_time"] is None:
             continue
+        sample_time_strings[(stream, sample_nb)] = sample_dict["actual_sample_time"]
         for vial_nb, filename in sample_dict["lsc_vials_filenames"].items():
-            sample = create_sample(
-                label=f"1L-{stream}_{run_nb}-{sample_nb}-{vial_nb}",
-                filename=f"{lsc_data_folder}/{filename}",
-                background_curve=background_curve,
+            vials.append(
+                (
+                    stream,
+                    sample_nb,
+                    f"1L-{stream}_{run_nb}-{sample_nb}-{vial_nb}",
+                    f"{lsc_data_folder}/{filename}",
+                )
             )
-            libra_samples.append(sample)
 
-        time_sample = datetime.strptime(
-            sample_dict["actual_sample_time"], "%m/%d/%Y %H:%M"
+# group the vial labels by LSC file
+vial_labels = {}
+for _, _, label, filename in vials:
+    vial_labels.setdefault(filename, []).append(label)
+
+# read all LSC files up front
+preload_file_readers(list(vial_labels))
+
+sample_times = dict(
+    zip(sample_time_strings, _parse_dts(list(sample_time_strings.values())))
+)
+
+# evaluate the background curve once per LSC file
+scalar_backgrounds = {}
+if curved_bkgr:
+    for filename, labels in vial_labels.items():
+        scalar_backgrounds[filename] = compute_scalar_backgrounds(
+            filename, labels, background_curve
         )
-        stream_samples.append(LIBRASample(libra_samples, time=time_sample))
-    gas_streams[stream] = GasStream(stream_samples, start_time=start_time)
+
+# create LSC samples
+lsc_samples = {}
+for stream, sample_nb, label, filename in vials:
+    sample = create_sample(
+        label=label,
+        filename=filename,
+        background_bq=scalar_backgrounds[filename][label] if curved_bkgr else None,
+    )
+    lsc_samples.setdefault((stream, sample_nb), []).append(sample)
+
+# create gas streams
+stream_samples = {stream: [] for stream in general_data["tritium_detection"]}
+for (stream, sample_nb), time_sample in sample_times.items():
+    libra_samples = lsc_samples.get((stream, sample_nb), [])
+    stream_samples[stream].append(LIBRASample(libra_samples, time=time_sample))
+
+gas_streams = {
+    stream: GasStream(samples, start_time=start_time)
+    for stream, samples in stream_samples.items()
+}
 
 
 # create run
 run = LIBRARun(streams=list(gas_streams.values()), start_time=start_time)
 
 # check that only one quench set is used
-assert len(np.unique(all_quench)) == 1
+assert len(set(all_quench)) == 1, "inconsistent quench sets"
 
 # check that background is always substracted  # TODO this should be done automatically in LIBRARun
 for stream in run.streams:
@@ -183,18 +344,28 @@ for stream in run.streams:
 IV_stream = gas_streams["IV"]
 OV_stream = gas_streams["OV"]
 
-sampling_times = {
-    "IV": sorted(IV_stream.relative_times_as_pint),
-    "OV": sorted(OV_stream.relative_times_as_pint),
+# compute the cumulative activities once per stream and form
+cumulative_activities = {
+    label: {
+        form: gas_stream.get_cumulative_activity(form)
+        for form in ["total", "soluble", "insoluble"]
+    }
+    for label, gas_stream in gas_streams.items()
 }
 
+# sort the magnitudes with numpy rather than comparing pint scalars
+sampling_times = {}
+for label, gas_stream in [("IV", IV_stream), ("OV", OV_stream)]:
+    relative_times = gas_stream.relative_times_as_pint
+    sampling_times[label] = np.sort(relative_times.magnitude) * relative_times.units
+
 replacement_times_top = sampling_times["IV"]
 replacement_times_walls = sampling_times["OV"]
 
 # read gas change time
 if general_data["cover_gas"]["switched_to"]["gas_switch_time"]:
     gas_switch_time = datetime.strptime(
-        general_data["cover_gas"]["switched_to"]["gas_switch_time"], "%m/%d/%Y %H:%M"
+        general_data["cover_gas"]["switched_to"]["gas_switch_time"], DATETIME_FORMAT
     )
     gas_switch_deltatime = gas_switch_time - start_time
     gas_switch_deltatime = gas_switch_deltatime.total_seconds() * ureg.s
@@ -210,21 +381,17 @@ baby_height = baby_volume / baby_cross_section
 
 # read irradiation times from general.json
 
-irradiations = []
-for generator in general_data["generators"]:
-    if generator["enabled"] is False:
-        continue
-    for irradiation_period in generator["periods"]:
-        irr_start_time = (
-            datetime.strptime(irradiation_period["start"], "%m/%d/%Y %H:%M")
-            - start_time
-        )
-        irr_stop_time = (
-            datetime.strptime(irradiation_period["end"], "%m/%d/%Y %H:%M") - start_time
-        )
-        irr_start_time = irr_start_time.total_seconds() * ureg.second
-        irr_stop_time = irr_stop_time.total_seconds() * ureg.second
-        irradiations.append([irr_start_time, irr_stop_time])
+# plain float seconds, wrapped as pint quantities only for the model
+irr_starts_s = np.array(
+    [(irr_start - start_time).total_seconds() for irr_start, _ in irradiation_periods]
+)
+irr_stops_s = np.array(
+    [(irr_stop - start_time).total_seconds() for _, irr_stop in irradiation_periods]
+)
+irradiations = [
+    [irr_start * ureg.second, irr_stop * ureg.second]
+    for irr_start, irr_stop in zip(irr_starts_s, irr_stops_s)
+]
 
 # Neutron rate
 
@@ -247,23 +414,25 @@ if not filename.exists():
 
 import openmc
 
-sp = openmc.StatePoint(filename)
-tally_df = sp.get_tally(name="TBR").get_pandas_dataframe()
-calculated_TBR = tally_df["mean"].iloc[0] * ureg.particle * ureg.neutron**-1
-calculated_TBR_std_dev = (
-    tally_df["std. dev."].iloc[0] * ureg.particle * ureg.neutron**-1
-)
+# only the TBR tally is needed: skip linking the summary and building a DataFrame
+with openmc.StatePoint(filename, autolink=False) as sp:
+    tbr_tally = sp.get_tally(name="TBR")
+    tbr_mean = tbr_tally.mean.flat[0]
+    tbr_std_dev = tbr_tally.std_dev.flat[0]
+
+calculated_TBR = tbr_mean * ureg.particle * ureg.neutron**-1
+calculated_TBR_std_dev = tbr_std_dev * ureg.particle * ureg.neutron**-1
 
 # TBR from measurements
 
-total_irradiation_time = sum([irr[1] - irr[0] for irr in irradiations])
+total_irradiation_time = float((irr_stops_s - irr_starts_s).sum()) * ureg.second
 
 T_consumed = neutron_rate * total_irradiation_time
 
 # to calculate the measured TBR we ignore the last samples for which
 # we have some contribution from other sources (nGen, cyclotron, etc.)
 nb_samples_included_iv = len(IV_stream.samples)
-T_produced_IV = IV_stream.get_cumulative_activity("total")[nb_samples_included_iv - 1]
+T_produced_IV = cumulative_activities["IV"]["total"][nb_samples_included_iv - 1]
 
 measured_TBR = (T_produced_IV / quantity_to_activity(T_consumed)).to(
     ureg.particle * ureg.neutron**-1
@@ -286,6 +455,19 @@ baby_model = Model(
 
 
 # store processed data
+cumulative_tritium_release = {}
+for label, gas_stream in gas_streams.items():
+    cum = {}
+    for form in ["total", "soluble", "insoluble"]:
+        q = cumulative_activities[label][form]
+        cum[form] = {"value": q.magnitude, "unit": str(q.units)}
+    relative_times = gas_stream.relative_times_as_pint
+    cum["sampling_times"] = {
+        "value": relative_times.magnitude,
+        "unit": str(relative_times.units),
+    }
+    cumulative_tritium_release[label] = cum
+
 processed_data = {
     "modelled_baby_radius": {
         "value": baby_radius.magnitude,
@@ -328,24 +510,7 @@ processed_data = {
         "value": baby_model.k_wall.magnitude,
         "unit": str(baby_model.k_wall.units),
     },
-    "cumulative_tritium_release": {
-        label: {
-            **{
-                form: {
-                    "value": gas_stream.get_cumulative_activity(
-                        form
-                    ).magnitude.tolist(),
-                    "unit": str(gas_stream.get_cumulative_activity(form).units),
-                }
-                for form in ["total", "soluble", "insoluble"]
-            },
-            "sampling_times": {
-                "value": gas_stream.relative_times_as_pint.magnitude.tolist(),
-                "unit": str(gas_stream.relative_times_as_pint.units),
-            },
-        }
-        for label, gas_stream in gas_streams.items()
-    },
+    "cumulative_tritium_release": cumulative_tritium_release,
 }
 
 # check if the file exists and load it
@@ -362,6 +527,6 @@ except FileNotFoundError:
 existing_data.update(processed_data)
 
 with open(processed_data_file, "w") as f:
-    json.dump(existing_data, f, indent=4)
+    json.dump(existing_data, f, indent=4, default=_to_json_serializable)
 
 print(f"Processed data stored in {processed_data_file}")